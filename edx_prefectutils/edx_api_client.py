@@ -1,11 +1,24 @@
 """A simple client for authenticated access to Open edX REST APIs."""
 
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 
+import aiohttp
 import backoff
+import diskcache
+import orjson
 import requests
 from prefect.utilities.logging import get_logger
+from requests.adapters import HTTPAdapter
 from requests.auth import AuthBase
+from requests.structures import CaseInsensitiveDict
+
+LOGGER = get_logger()
 
 DEFAULT_RETRY_STATUS_CODES = (
     requests.codes.request_timeout,         # HTTP Status Code 408
@@ -16,6 +29,20 @@ DEFAULT_RETRY_STATUS_CODES = (
     520,                                    # This is a custom Cloudwatch code for "Unknown error".
 )
 DEFAULT_TIMEOUT_SECONDS = 7200
+DEFAULT_POOL_SIZE = 32
+# Refresh tokens this many seconds before they actually expire, so requests don't race the server's clock.
+TOKEN_EXPIRY_SKEW_SECONDS = 60
+TOKEN_REQUEST_TIMEOUT_SECONDS = 60
+# Abandon (and retry) a single concurrent page request that takes longer than this.
+PAGE_REQUEST_TIMEOUT_SECONDS = 300
+# Cached pages are read back with pickle, so they are kept in a directory only the current user can access.
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'edx_api_cache')
+
+# Tokens shared by every client in this process, keyed by (auth_url, client_id, client_secret hash, token_type).
+_TOKEN_CACHE = {}
+# One lock per cache key, so a slow token endpoint only holds up clients that share its credentials.
+_TOKEN_CACHE_LOCKS = {}
+_TOKEN_CACHE_LOCKS_LOCK = threading.Lock()
 
 
 class EdxApiClient(object):
@@ -32,22 +59,37 @@ class EdxApiClient(object):
             the "client_secret" field of the "edx-rest-api" section of the configuration file.
         token_type (str): The type of authentication token required for the API call.  Should be one of 'jwt' (default)
             or 'bearer'.
+        cache_directory (str): The directory in which responses are cached when `paginated_get` is called with
+            `cache_ttl_seconds`. It is created readable by the current user only. Defaults to `~/.cache/edx_api_cache`.
     """
 
     def __init__(self, auth_url=None,
                  client_id=None, client_secret=None,
-                 token_type=None):
+                 token_type=None, cache_directory=None):
 
         self._expires_at = None
-        self._session = requests.Session()
-        self._session.hooks = {
-            'response': log_response_hook
-        }
+        self._session = self._create_session()
 
         self.client_id = client_id
         self.client_secret = client_secret
         self.auth_url = auth_url
         self.token_type = token_type or 'jwt'
+        self.cache_directory = cache_directory or DEFAULT_CACHE_DIRECTORY
+        self._response_cache = None
+
+    @staticmethod
+    def _create_session():
+        """Creates a session that keeps connections alive and logs every response."""
+        session = requests.Session()
+        # Keep connections to the API host alive across pages so TLS handshakes aren't repeated.
+        adapter = HTTPAdapter(pool_connections=DEFAULT_POOL_SIZE, pool_maxsize=DEFAULT_POOL_SIZE, pool_block=False)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Connection'] = 'keep-alive'
+        session.hooks = {
+            'response': log_response_hook
+        }
+        return session
 
     @property
     def authenticated_session(self):
@@ -57,10 +99,24 @@ class EdxApiClient(object):
 
     def ensure_oauth_access_token(self):
         """Retrieves OAuth 2.0 access token using the client credentials grant and stores it in the request session."""
-        logger = get_logger()
-        now = datetime.utcnow()
-        if self._expires_at is None or now >= self._expires_at:
-            logger.info('Token is expired or missing, requesting a new one.')
+        # A monotonic clock is cheap to read on every request and immune to wall clock adjustments.
+        now = time.monotonic()
+        if self._expires_at is not None and now < self._expires_at:
+            return
+
+        secret_hash = hashlib.sha256((self.client_secret or '').encode()).hexdigest()
+        cache_key = (self.auth_url, self.client_id, secret_hash, self.token_type)
+        with _TOKEN_CACHE_LOCKS_LOCK:
+            lock = _TOKEN_CACHE_LOCKS.setdefault(cache_key, threading.Lock())
+
+        with lock:
+            cached = _TOKEN_CACHE.get(cache_key)
+            if cached is not None and now < cached[1]:
+                # Another client with the same credentials already holds a live token.
+                self._session.auth, self._expires_at = cached
+                return
+
+            LOGGER.info('Token is expired or missing, requesting a new one.')
 
             data = {
                 'grant_type': 'client_credentials',
@@ -69,17 +125,19 @@ class EdxApiClient(object):
                 'token_type': self.token_type,
             }
 
-            response = requests.post(
-                self.auth_url,
-                data=data,
-                hooks={
-                    'response': log_response_hook
-                }
-            )
-            data = response.json()
+            # Reuse the pooled session, but don't send the stale token to the token endpoint.
+            self._session.auth = None
+            response = self._session.post(self.auth_url, data=data, timeout=TOKEN_REQUEST_TIMEOUT_SECONDS)
+            data = orjson.loads(response.content)
             self._session.auth = SuppliedAuth(data['access_token'], data.get('token_type', self.token_type))
-            self._expires_at = now + timedelta(seconds=data['expires_in'])
-            logger.info("Acquired a token that expires at {}".format(self._expires_at.isoformat()))
+            # Never let the skew eat more than half of a short-lived token's lifetime.
+            skew = min(TOKEN_EXPIRY_SKEW_SECONDS, data['expires_in'] / 2)
+            self._expires_at = now + data['expires_in'] - skew
+            _TOKEN_CACHE[cache_key] = (self._session.auth, self._expires_at)
+            LOGGER.info(
+                "Acquired a token that expires at %s",
+                (datetime.utcnow() + timedelta(seconds=data['expires_in'])).isoformat()
+            )
 
     def get(self, url, params=None, timeout_seconds=DEFAULT_TIMEOUT_SECONDS, retry_on=DEFAULT_RETRY_STATUS_CODES):
         """
@@ -103,7 +161,8 @@ class EdxApiClient(object):
                                        pagination_key=None))
 
     def paginated_get(self, url, params=None, timeout_seconds=DEFAULT_TIMEOUT_SECONDS,
-                      retry_on=DEFAULT_RETRY_STATUS_CODES, pagination_key='next'):
+                      retry_on=DEFAULT_RETRY_STATUS_CODES, pagination_key='next', hedge_delay_seconds=None,
+                      cache_ttl_seconds=None):
         """
         Fetches a paginated resource.
 
@@ -127,17 +186,76 @@ class EdxApiClient(object):
                 E.g., use "pagination_key=lambda r: r['pagination']['next']" for a response that looks like this:
 
                 {"results": [...], "pagination": {"next": "http://...", "previous": "http://..."}}
-
-        Yields: A single requests.Response object for each page of data received from the server.
+            hedge_delay_seconds (float): If set, a duplicate request for a page is sent when the first one hasn't
+                completed after this many seconds, and whichever response arrives first is used. A value close to the
+                95th percentile latency of the endpoint trims the slow tail at the cost of a few extra requests.
+            cache_ttl_seconds (float): If set, the pages of the resource are cached on disk for this many seconds along
+                with the ETag / Last-Modified headers of the first page. While cached, the first page is requested
+                conditionally and if the server answers "304 Not Modified" the cached pages are yielded instead of
+                walking the whole resource again.
+
+        Yields: A single requests.Response object for each page of data received from the server. Use
+            `get_cached_json` to read its body without parsing it again.
         """
 
+        def hedged_get(session, *args, **kwargs):
+            """Issue a GET, racing it against a duplicate if it takes longer than `hedge_delay_seconds`."""
+            if hedge_delay_seconds is None:
+                return session.get(*args, **kwargs)
+
+            # Don't use the executor as a context manager, it would wait for the losing request to finish.
+            executor = ThreadPoolExecutor(max_workers=2)
+            try:
+                primary = executor.submit(session.get, *args, **kwargs)
+                futures = [primary]
+                done, _ = wait(futures, timeout=hedge_delay_seconds)
+                if not done:
+                    # Sessions aren't guaranteed to be thread-safe, so the duplicate request gets one of its own.
+                    hedge_session = self._create_session()
+                    hedge_session.auth = session.auth
+                    hedge = executor.submit(hedge_session.get, *args, **kwargs)
+                    # The body is read before the request completes, so the session can be closed right after.
+                    hedge.add_done_callback(lambda _: hedge_session.close())
+                    futures.append(hedge)
+
+                # Use the first request that succeeds, only failing if they all do.
+                winner = None
+                pending = set(futures)
+                while pending and winner is None:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    winner = next((future for future in futures if future in done and future.exception() is None),
+                                  None)
+                if winner is None:
+                    return primary.result()
+
+                for future in futures:
+                    if future is not winner:
+                        future.add_done_callback(close_response)
+                return winner.result()
+            finally:
+                executor.shutdown(wait=False)
+
+        # When the page currently being fetched must be fetched by, set while its retries are in progress.
+        retry_deadline = None
+
+        def start_retry_timer():
+            """Sets the deadline for the page being fetched, when its first attempt starts."""
+            nonlocal retry_deadline
+            if retry_deadline is None:
+                retry_deadline = time.monotonic() + timeout_seconds
+
+        def reset_retry_timer(details):  # pylint: disable=unused-argument
+            """Clears the deadline once the page was fetched or its retries were abandoned."""
+            nonlocal retry_deadline
+            retry_deadline = None
+
         def get_next_url_from_response(response):
             """Returns the next page's URL from the response, as located by pagination_key."""
-            response_obj = response.json()
+            # The parsed body is kept on the response, so callers using `get_cached_json` don't parse it again.
             if isinstance(pagination_key, str):
-                return response_obj.get(pagination_key)
+                return get_cached_json(response).get(pagination_key)
             elif callable(pagination_key):
-                return pagination_key(response_obj)
+                return pagination_key(get_cached_json(response))
             else:
                 return None
 
@@ -150,15 +268,32 @@ class EdxApiClient(object):
             if error_response is None:
                 return True
 
-            return error_response.status_code not in retry_on
+            if error_response.status_code not in retry_on:
+                return True
+
+            if error_response.status_code == requests.codes.too_many_requests:
+                wait_seconds = retry_after_seconds(error_response.headers)
+                if wait_seconds is not None:
+                    # Don't wait for the server past our own deadline, give up instead.
+                    if time.monotonic() + wait_seconds >= retry_deadline:
+                        return True
+                    # Never retry sooner than the server asked us to. The back-off delay is added on top of this.
+                    time.sleep(wait_seconds)
+
+            return False
 
         @backoff.on_exception(backoff.expo,
                               requests.exceptions.RequestException,
                               max_time=timeout_seconds,
-                              giveup=should_giveup)
-        def get_resource_with_retry(next_url=None):
+                              jitter=backoff.full_jitter,
+                              base=2,
+                              factor=0.5,
+                              giveup=should_giveup,
+                              on_success=reset_retry_timer,
+                              on_giveup=reset_retry_timer)
+        def get_resource_with_retry(next_url=None, headers=None):
             """
-            Attempt to get the resource, using an exponetial back-off to retry recoverable, failed requests.
+            Attempt to get the resource, using a jittered exponential back-off to retry recoverable, failed requests.
 
             Arguments:
                 next_url (str): The url of the next page to fetch. If this is `None` this is the first page, so we
@@ -166,25 +301,153 @@ class EdxApiClient(object):
                     The next url is provided in the first response with all of the appropriate parameters needed to
                     fetch the next page of data. We don't want to accidentally override existing parameters so we omit
                     the `params` kwarg from the call.
+                headers (dict): Extra headers to send with the request.
             """
+            start_retry_timer()
             if next_url is None:
-                raw_response = self.authenticated_session.get(url, params=params)
+                raw_response = hedged_get(self.authenticated_session, url, params=params, headers=headers)
             else:
-                raw_response = self.authenticated_session.get(next_url)
+                raw_response = hedged_get(self.authenticated_session, next_url, headers=headers)
 
             raw_response.raise_for_status()
+            if raw_response.status_code == requests.codes.not_modified:
+                return raw_response, None
 
             # Get next URL if pagination was requested
             next_url = get_next_url_from_response(raw_response)
 
             return raw_response, next_url
 
-        next_url = None
-        while True:
+        if cache_ttl_seconds is None:
+            next_url = None
+            while True:
+                response, next_url = get_resource_with_retry(next_url)
+                yield response
+                if next_url is None:
+                    break
+            return
+
+        if self._response_cache is None:
+            os.makedirs(self.cache_directory, mode=0o700, exist_ok=True)
+            self._response_cache = diskcache.Cache(self.cache_directory)
+        cache_key = (url, tuple(sorted((params or {}).items())))
+        cached = self._response_cache.get(cache_key)
+
+        headers = {}
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        response, next_url = get_resource_with_retry(headers=headers)
+        if response.status_code == requests.codes.not_modified:
+            if cached is None:
+                # Nothing to replay, the server answered a request that wasn't conditional.
+                yield response
+            else:
+                yield from (from_cached_page(page) for page in cached[2])
+            return
+
+        responses = [response]
+        yield response
+        while next_url is not None:
             response, next_url = get_resource_with_retry(next_url)
+            responses.append(response)
             yield response
-            if next_url is None:
-                break
+
+        etag = responses[0].headers.get('ETag')
+        last_modified = responses[0].headers.get('Last-Modified')
+        if etag or last_modified:
+            # Only keep what's needed to replay the pages, the requests that fetched them carry our token.
+            pages = [to_cached_page(response) for response in responses]
+            self._response_cache.set(cache_key, (etag, last_modified, pages), expire=cache_ttl_seconds)
+
+    async def paginated_get_async(self, url, params=None, page_param='page', num_pages_key='num_pages',
+                                  concurrency=8, timeout_seconds=DEFAULT_TIMEOUT_SECONDS,
+                                  retry_on=DEFAULT_RETRY_STATUS_CODES):
+        """
+        Fetches every page of a page-number paginated resource concurrently.
+
+        The first page is fetched synchronously to learn the total number of pages, then the remaining pages are
+        requested in parallel. Use `paginated_get` instead for resources that only expose an opaque "next" URL.
+
+        Arguments:
+            url (str): The URL of the resource.
+            params (dict): This is a dictionary of key-value pairs that are URL encoded and injected into the query
+                string when making the request.
+            page_param (str): The name of the query string parameter that selects a page.
+            num_pages_key (str): The field at the root of the first page's JSON-parsed response containing the total
+                number of pages.
+            concurrency (int): The maximum number of pages being requested at the same time.
+            timeout_seconds (float): When requesting a page, keep retrying unless this much time has elapsed. A
+                Retry-After wait requested by the server that would end after this much time since the concurrent
+                requests started makes the request give up instead.
+            retry_on (iterable): This is a set of HTTP status codes that should trigger a retry of the request if they
+                are received from the server in the response.
+
+        Returns: A list with the JSON-parsed body of every page, in page order.
+        """
+        first_page = get_cached_json(
+            self.get(url, params=params, timeout_seconds=timeout_seconds, retry_on=retry_on)
+        )
+        num_pages = first_page.get(num_pages_key) or 1
+        if num_pages <= 1:
+            return [first_page]
+
+        semaphore = asyncio.Semaphore(concurrency)
+        retry_deadline = time.monotonic() + timeout_seconds
+
+        async def should_giveup(error):
+            """
+            Give up if the status code is not in the set of status codes that are retryable, or if the server asked us
+            to wait past our deadline. Connection errors and timeouts are always retried.
+            """
+            if not isinstance(error, aiohttp.ClientResponseError):
+                return False
+
+            if error.status not in retry_on:
+                return True
+
+            if error.status == requests.codes.too_many_requests:
+                wait_seconds = retry_after_seconds(error.headers or {})
+                if wait_seconds is not None:
+                    # Don't wait for the server past our own deadline, give up instead.
+                    if time.monotonic() + wait_seconds >= retry_deadline:
+                        return True
+                    # Never retry sooner than the server asked us to. This runs outside of `get_page_with_retry`, so
+                    # other pages can use the concurrency slot in the meantime.
+                    await asyncio.sleep(wait_seconds)
+
+            return False
+
+        @backoff.on_exception(backoff.expo,
+                              (aiohttp.ClientResponseError, aiohttp.ClientConnectionError, asyncio.TimeoutError),
+                              max_time=timeout_seconds,
+                              jitter=backoff.full_jitter,
+                              base=2,
+                              factor=0.5,
+                              giveup=should_giveup)
+        async def get_page_with_retry(session, page):
+            """Fetch a single page, using an exponential back-off to retry recoverable, failed requests."""
+            page_params = dict(params or {}, **{page_param: page})
+            async with semaphore:
+                # Read the token for every request, it may have been refreshed since the pages were scheduled.
+                headers = {'Authorization': self.authenticated_session.auth.header}
+                async with session.get(url, params=page_params, headers=headers) as response:
+                    LOGGER.info("[GET] [%s] %s", response.status, response.url)
+                    response.raise_for_status()
+                    return orjson.loads(await response.read())
+
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        timeout = aiohttp.ClientTimeout(total=PAGE_REQUEST_TIMEOUT_SECONDS)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            pages = await asyncio.gather(
+                *[get_page_with_retry(session, page) for page in range(2, num_pages + 1)]
+            )
+
+        return [first_page] + list(pages)
 
 
 class SuppliedAuth(AuthBase):
@@ -195,17 +458,65 @@ class SuppliedAuth(AuthBase):
         self.token = token
         self.token_type = token_type
 
+    @property
+    def header(self):
+        """The value of the Authorization header for this token."""
+        return '{token_type} {token}'.format(token_type=self.token_type, token=self.token)
+
     def __call__(self, r):
         """Update the request headers."""
-        r.headers['Authorization'] = '{token_type} {token}'.format(token_type=self.token_type, token=self.token)
+        r.headers['Authorization'] = self.header
         return r
 
 
+def retry_after_seconds(headers):
+    """Returns the number of seconds a Retry-After header asks to wait, or `None` if it isn't given in seconds."""
+    retry_after = headers.get('Retry-After', '')
+    return int(retry_after) if retry_after.isdigit() else None
+
+
+def get_cached_json(response):
+    """
+    Returns the JSON-parsed body of the response, parsing it at most once with orjson rather than `response.json()`.
+
+    Responses yielded by `EdxApiClient.paginated_get` may already have been parsed to locate the next page.
+    """
+    if not hasattr(response, '_cached_json'):
+        response._cached_json = orjson.loads(response.content)  # pylint: disable=protected-access
+    return response._cached_json  # pylint: disable=protected-access
+
+
+def to_cached_page(response):
+    """Returns the parts of a response needed to rebuild it with `from_cached_page`, leaving out its request."""
+    return {
+        'status_code': response.status_code,
+        'headers': dict(response.headers),
+        'content': response.content,
+        'url': response.url,
+        'encoding': response.encoding,
+    }
+
+
+def from_cached_page(page):
+    """Rebuilds a response from the output of `to_cached_page`."""
+    response = requests.Response()
+    response.status_code = page['status_code']
+    response.headers = CaseInsensitiveDict(page['headers'])
+    response._content = page['content']  # pylint: disable=protected-access
+    response.url = page['url']
+    response.encoding = page['encoding']
+    return response
+
+
+def close_response(future):
+    """Release the connection held by the response of a request that is no longer needed."""
+    if future.exception() is None:
+        future.result().close()
+
+
 def log_response_hook(response, *args, **kwargs):  # pylint: disable=unused-argument
     """Log summary information about every request made."""
-    logger = get_logger()
-    logger.info(
-        "[{}] [{}] [{}] {}".format(
-            response.request.method, response.status_code, response.elapsed.total_seconds(), response.url
-        )
+    LOGGER.info(
+        "[%s] [%s] [%s] %s",
+        response.request.method, response.status_code, response.elapsed.total_seconds(), response.url
     )
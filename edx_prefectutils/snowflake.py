@@ -1,7 +1,9 @@
 """
 Utility methods and tasks for working with Snowflake from a Prefect flow.
 """
+import functools
 import os
+import string
 from collections import namedtuple
 from typing import List, TypedDict
 
@@ -44,49 +46,174 @@ def create_snowflake_connection(
     account = credentials.get("account")
     password = credentials.get("password")
 
-    p_key = None
     pkb = None
     if private_key and private_key_passphrase:
-        p_key = serialization.load_pem_private_key(
-            private_key.encode(),
-            password=private_key_passphrase.encode(),
-            backend=default_backend(),
-        )
-
-        pkb = p_key.private_bytes(
-            encoding=serialization.Encoding.DER,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption(),
-        )
+        pkb = _load_private_key_der(private_key.encode(), private_key_passphrase.encode())
 
+    # Pass the role and UTC timezone at login, rather than with extra round trips to run USE ROLE / ALTER SESSION.
     connection = snowflake.connector.connect(
-        user=user, account=account, private_key=pkb, password=password, autocommit=autocommit, warehouse=warehouse
+        user=user, account=account, private_key=pkb, password=password, autocommit=autocommit, warehouse=warehouse,
+        role=role, session_parameters={'TIMEZONE': 'UTC'},
     )
 
-    # Switch to specified role.
-    connection.cursor().execute("USE ROLE {}".format(role))
-    # Set timezone to UTC
-    connection.cursor().execute("ALTER SESSION SET TIMEZONE = 'UTC'")
-
     return connection
 
 
+@functools.lru_cache(maxsize=8)
+def _load_private_key_der(private_key: bytes, private_key_passphrase: bytes) -> bytes:
+    """
+    Decrypts a PEM private key and returns it DER encoded, caching the result since decryption is costly.
+    """
+    p_key = serialization.load_pem_private_key(
+        private_key,
+        password=private_key_passphrase,
+        backend=default_backend(),
+    )
+
+    return p_key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
 def qualified_table_name(database, schema, table) -> str:
     """
     Fully qualified Snowflake table name.
     """
-    return "{database}.{schema}.{table}".format(
-        database=database, schema=schema, table=table
-    )
+    return f"{database}.{schema}.{table}"
 
 
 def qualified_stage_name(database, schema, table) -> str:
     """
     Fully qualified Snowflake stage name.
     """
-    return "{database}.{schema}.{table}_stage".format(
-        database=database, schema=schema, table=table,
+    return f"{database}.{schema}.{table}_stage"
+
+
+# SQL used by the tasks in this module. Literal `$` characters are escaped as `$$`.
+_TABLE_EXISTS_TEMPLATE = string.Template("""
+SELECT TRUE FROM $database.INFORMATION_SCHEMA.TABLES
+WHERE TABLE_SCHEMA=UPPER(%(schema)s)
+    AND TABLE_NAME=UPPER(%(table)s)
+LIMIT 1
+""")
+
+_GA_DATA_EXISTS_TEMPLATE = string.Template("""
+SELECT TRUE FROM $table
+WHERE session:date=%(date)s
+    AND ga_view_id=%(ga_view_id)s
+LIMIT 1
+""")
+
+_GA_CREATE_TABLE_TEMPLATE = string.Template("""
+CREATE TABLE IF NOT EXISTS $table (
+    id number autoincrement start 1 increment 1,
+    load_time timestamp_ltz default current_timestamp(),
+    ga_view_id string,
+    session VARIANT
+);
+""")
+
+_GA_DELETE_TEMPLATE = string.Template("""
+DELETE FROM $table
+WHERE session:date=%(date)s
+    AND ga_view_id=%(ga_view_id)s
+""")
+
+_GA_CREATE_STAGE_TEMPLATE = string.Template("""
+CREATE OR REPLACE STAGE $stage
+    URL = '$stage_url'
+    STORAGE_INTEGRATION = $storage_integration
+    FILE_FORMAT = (TYPE = JSON);
+""")
+
+_GA_COPY_INTO_TEMPLATE = string.Template("""
+COPY INTO $table (ga_view_id, session)
+    FROM (
+        SELECT
+            %(ga_view_id)s,
+            t.$$1
+        FROM @$stage t
     )
+PATTERN=%(pattern)s
+FORCE=%(force)s
+""")
+
+_S3_TRUNCATE_TEMPLATE = string.Template("TRUNCATE IF EXISTS $table")
+
+_S3_DATA_EXISTS_TEMPLATE = string.Template("""
+SELECT TRUE FROM $table
+WHERE date(PROPERTIES:$date_property)=date(%(date)s)
+LIMIT 1
+""")
+
+_S3_CREATE_TABLE_TEMPLATE = string.Template("""
+CREATE TABLE IF NOT EXISTS $table (
+    ID NUMBER AUTOINCREMENT START 1 INCREMENT 1,
+    LOAD_TIME TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP(),
+    ORIGIN_FILE_NAME VARCHAR(16777216),
+    ORIGIN_FILE_LINE NUMBER(38,0),
+    ORIGIN_STR VARCHAR(16777216),
+    PROPERTIES VARIANT
+);
+""")
+
+_S3_DELETE_TEMPLATE = string.Template("""
+DELETE FROM $table
+WHERE date(PROPERTIES:$date_property)=date(%(date)s)
+""")
+
+_S3_CREATE_STAGE_TEMPLATE = string.Template("""
+CREATE STAGE IF NOT EXISTS $stage
+    URL = '$stage_url'
+    STORAGE_INTEGRATION = $storage_integration
+    FILE_FORMAT = ($file_format);
+""")
+
+_S3_COPY_INTO_TEMPLATE = string.Template("""
+COPY INTO $table (origin_file_name, origin_file_line, origin_str, properties)
+    FROM (
+        SELECT
+            metadata$$filename,
+            metadata$$file_row_number,
+            t.$$1,
+            CASE
+                WHEN CHECK_JSON(t.$$1) IS NULL THEN t.$$1
+                ELSE NULL
+            END
+        FROM @$stage t
+    )
+$files_parameter
+$pattern_parameter
+FORCE=%(force)s
+""")
+
+_EXPORT_COPY_INTO_TEMPLATE = string.Template("""
+COPY INTO '$export_path'
+    FROM $table
+    STORAGE_INTEGRATION = $storage_integration
+    FILE_FORMAT = ( TYPE = CSV EMPTY_FIELD_AS_NULL = FALSE
+    FIELD_DELIMITER = '$field_delimiter' FIELD_OPTIONALLY_ENCLOSED_BY = '$enclosed_by'
+    ESCAPE_UNENCLOSED_FIELD = '$escape_unenclosed_field'
+    NULL_IF = ( '$null_marker' )
+    COMPRESSION = NONE
+    )
+    OVERWRITE=$overwrite
+""")
+
+_SELECT_COLUMNS_TEMPLATE = string.Template("SELECT $columns FROM $table")
+
+
+def check_table_exists(cursor, database, schema, table) -> bool:
+    """
+    Whether the Snowflake table exists, looked up in the database's INFORMATION_SCHEMA.
+
+    Unquoted identifiers are stored upper-cased by Snowflake, so names are compared upper-cased.
+    """
+    query = _TABLE_EXISTS_TEMPLATE.substitute(database=database)
+    cursor.execute(query, {'schema': schema, 'table': table})
+    return cursor.fetchone() is not None
 
 
 @task
@@ -126,93 +253,49 @@ def load_ga_data_to_snowflake(
       overwrite (bool, optional): Whether to overwrite existing data for the given date. Defaults to `False`.
     """
     sf_connection = create_snowflake_connection(sf_credentials, sf_role)
-    # Snowflake expects GCS locations to start with `gcs` instead of `gs`.
-    gcs_url = gcs_url.replace("gs://", "gcs://")
-
-    # Check for data existence for this date
-    try:
-        query = """
-        SELECT 1 FROM {table}
-        WHERE session:date='{date}'
-            AND ga_view_id='{ga_view_id}'
-        """.format(
-            table=qualified_table_name(sf_database, sf_schema, sf_table),
-            date=date,
-            ga_view_id=bq_dataset,
-        )
-        cursor = sf_connection.cursor()
-        cursor.execute(query)
-        row = cursor.fetchone()
-    except snowflake.connector.ProgrammingError as e:
-        if "does not exist" in e.msg:
-            # If so then the query failed because the table doesn't exist.
-            row = None
-        else:
-            raise
-
-    if row and not overwrite:
-        return
-
+    # Reuse a single cursor for every statement in this task.
+    cursor = sf_connection.cursor()
     try:
-        query = """
-        CREATE TABLE IF NOT EXISTS {table} (
-            id number autoincrement start 1 increment 1,
-            load_time timestamp_ltz default current_timestamp(),
-            ga_view_id string,
-            session VARIANT
-        );
-        """.format(
-            table=qualified_table_name(sf_database, sf_schema, sf_table)
-        )
-        sf_connection.cursor().execute(query)
-
-        if overwrite:
-            query = """
-            DELETE FROM {table}
-            WHERE session:date='{date}'
-                AND ga_view_id='{ga_view_id}'
-            """.format(
-                table=qualified_table_name(sf_database, sf_schema, sf_table),
-                date=date,
-                ga_view_id=bq_dataset,
-            )
-            sf_connection.cursor().execute(query)
-
-        query = """
-        CREATE OR REPLACE STAGE {stage_name}
-            URL = '{stage_url}'
-            STORAGE_INTEGRATION = {storage_integration}
-            FILE_FORMAT = (TYPE = JSON);
-        """.format(
-            stage_name=qualified_stage_name(sf_database, sf_schema, sf_table),
-            stage_url=gcs_url,
-            storage_integration=sf_storage_integration,
-        )
-        sf_connection.cursor().execute(query)
-
-        query = """
-        COPY INTO {table} (ga_view_id, session)
-            FROM (
-                SELECT
-                    '{ga_view_id}',
-                    t.$1
-                FROM @{stage_name} t
+        table_name = qualified_table_name(sf_database, sf_schema, sf_table)
+        stage_name = qualified_stage_name(sf_database, sf_schema, sf_table)
+        # Snowflake expects GCS locations to start with `gcs` instead of `gs`.
+        gcs_url = gcs_url.replace("gs://", "gcs://")
+
+        # Check for data existence for this date, only probing the table once we know it exists.
+        table_exists = check_table_exists(cursor, sf_database, sf_schema, sf_table)
+        row = None
+        if table_exists:
+            query = _GA_DATA_EXISTS_TEMPLATE.substitute(table=table_name)
+            cursor.execute(query, {'date': date, 'ga_view_id': bq_dataset})
+            row = cursor.fetchone()
+
+        if row and not overwrite:
+            return
+
+        try:
+            if not table_exists:
+                query = _GA_CREATE_TABLE_TEMPLATE.substitute(table=table_name)
+                cursor.execute(query)
+
+            if overwrite:
+                query = _GA_DELETE_TEMPLATE.substitute(table=table_name)
+                cursor.execute(query, {'date': date, 'ga_view_id': bq_dataset})
+
+            query = _GA_CREATE_STAGE_TEMPLATE.substitute(
+                stage=stage_name,
+                stage_url=gcs_url,
+                storage_integration=sf_storage_integration,
             )
-        PATTERN='{pattern}'
-        FORCE={force}
-        """.format(
-            table=qualified_table_name(sf_database, sf_schema, sf_table),
-            ga_view_id=bq_dataset,
-            stage_name=qualified_stage_name(sf_database, sf_schema, sf_table),
-            pattern=pattern,
-            force=str(overwrite),
-        )
-        sf_connection.cursor().execute(query)
-        sf_connection.commit()
-    except Exception:
-        sf_connection.rollback()
-        raise
+            cursor.execute(query)
+
+            query = _GA_COPY_INTO_TEMPLATE.substitute(table=table_name, stage=stage_name)
+            cursor.execute(query, {'ga_view_id': bq_dataset, 'pattern': pattern, 'force': overwrite})
+            sf_connection.commit()
+        except Exception:
+            sf_connection.rollback()
+            raise
     finally:
+        cursor.close()
         sf_connection.close()
 
 
@@ -276,129 +359,82 @@ def load_s3_data_to_snowflake(
         raise signals.FAIL('Either `file` or `pattern` must be specified to run this task.')
 
     sf_connection = create_snowflake_connection(sf_credentials, sf_role, warehouse=sf_warehouse)
-
-    if truncate:
-        query = "TRUNCATE IF EXISTS {}".format(qualified_table_name(sf_database, sf_schema, sf_table))
-        logger.info("Truncating table: {}".format(sf_table))
-        cursor = sf_connection.cursor()
-        cursor.execute(query)
-
-    # Check for data existence for this date
+    # Reuse a single cursor for every statement in this task.
+    cursor = sf_connection.cursor()
     try:
-        query = """
-        SELECT 1 FROM {table}
-        WHERE date(PROPERTIES:{date_property})=date('{date}')
-        """.format(
-            table=qualified_table_name(sf_database, sf_schema, sf_table),
-            date=date,
-            date_property=date_property,
-        )
+        table_name = qualified_table_name(sf_database, sf_schema, sf_table)
+        stage_name = qualified_stage_name(sf_database, sf_schema, sf_table)
 
+        if truncate:
+            query = _S3_TRUNCATE_TEMPLATE.substitute(table=table_name)
+            logger.info("Truncating table: {}".format(sf_table))
+            cursor.execute(query)
+
+        # Check for data existence for this date, only probing the table once we know it exists.
         logger.info("Checking existence of data for {}".format(date))
 
-        cursor = sf_connection.cursor()
-        cursor.execute(query)
-        row = cursor.fetchone()
-    except snowflake.connector.ProgrammingError as e:
-        if "does not exist" in e.msg:
-            # If so then the query failed because the table doesn't exist.
-            row = None
+        table_exists = check_table_exists(cursor, sf_database, sf_schema, sf_table)
+        row = None
+        if table_exists:
+            query = _S3_DATA_EXISTS_TEMPLATE.substitute(table=table_name, date_property=date_property)
+            cursor.execute(query, {'date': date})
+            row = cursor.fetchone()
+
+        if row and not overwrite:
+            raise signals.SKIP('Skipping task as data for the date exists and no overwrite was provided.')
         else:
-            raise
+            logger.info("Continuing with S3 load for {}".format(date))
+
+        try:
+            # Create the generic loading table, unless the existence check already found it.
+            if not table_exists:
+                query = _S3_CREATE_TABLE_TEMPLATE.substitute(table=table_name)
+                cursor.execute(query)
+
+            # Delete existing data in case of overwrite.
+            if overwrite and row:
+                logger.info("Deleting data for overwrite for {}".format(date))
+
+                query = _S3_DELETE_TEMPLATE.substitute(table=table_name, date_property=date_property)
+                cursor.execute(query, {'date': date})
+
+            # Create stage
+            query = _S3_CREATE_STAGE_TEMPLATE.substitute(
+                stage=stage_name,
+                stage_url=s3_url,
+                storage_integration=sf_storage_integration_name,
+                file_format=sf_file_format,
+            )
+            cursor.execute(query)
 
-    if row and not overwrite:
-        raise signals.SKIP('Skipping task as data for the date exists and no overwrite was provided.')
-    else:
-        logger.info("Continuing with S3 load for {}".format(date))
+            files_paramater = ""
+            pattern_parameter = ""
 
-    try:
-        # Create the generic loading table
-        query = """
-        CREATE TABLE IF NOT EXISTS {table} (
-            ID NUMBER AUTOINCREMENT START 1 INCREMENT 1,
-            LOAD_TIME TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP(),
-            ORIGIN_FILE_NAME VARCHAR(16777216),
-            ORIGIN_FILE_LINE NUMBER(38,0),
-            ORIGIN_STR VARCHAR(16777216),
-            PROPERTIES VARIANT
-        );
-        """.format(
-            table=qualified_table_name(sf_database, sf_schema, sf_table)
-        )
-
-        sf_connection.cursor().execute(query)
-
-        # Delete existing data in case of overwrite.
-        if overwrite and row:
-            logger.info("Deleting data for overwrite for {}".format(date))
-
-            query = """
-            DELETE FROM {table}
-            WHERE date(PROPERTIES:{date_property})=date('{date}')
-            """.format(
-                table=qualified_table_name(sf_database, sf_schema, sf_table),
-                date=date,
-                date_property=date_property,
-            )
-            sf_connection.cursor().execute(query)
-
-        # Create stage
-        query = """
-        CREATE STAGE IF NOT EXISTS {stage_name}
-            URL = '{stage_url}'
-            STORAGE_INTEGRATION = {storage_integration}
-            FILE_FORMAT = ({file_format});
-        """.format(
-            stage_name=qualified_stage_name(sf_database, sf_schema, sf_table),
-            stage_url=s3_url,
-            storage_integration=sf_storage_integration_name,
-            file_format=sf_file_format,
-        )
-        sf_connection.cursor().execute(query)
-
-        files_paramater = ""
-        pattern_parameter = ""
-
-        if file:
-            logger.info("Loading file {}".format(file))
-            files_paramater = "FILES = ( '{}' )".format(file)
-
-        if pattern:
-            logger.info("Loading pattern {}".format(pattern))
-            pattern_parameter = "PATTERN = '{}'".format(pattern)
-
-        query = """
-        COPY INTO {table} (origin_file_name, origin_file_line, origin_str, properties)
-            FROM (
-                SELECT
-                    metadata$filename,
-                    metadata$file_row_number,
-                    t.$1,
-                    CASE
-                        WHEN CHECK_JSON(t.$1) IS NULL THEN t.$1
-                        ELSE NULL
-                    END
-                FROM @{stage_name} t
+            if file:
+                logger.info("Loading file {}".format(file))
+                files_paramater = "FILES = ( %(file)s )"
+
+            if pattern:
+                logger.info("Loading pattern {}".format(pattern))
+                pattern_parameter = "PATTERN = %(pattern)s"
+
+            query = _S3_COPY_INTO_TEMPLATE.substitute(
+                table=table_name,
+                stage=stage_name,
+                files_parameter=files_paramater,
+                pattern_parameter=pattern_parameter,
             )
-        {files_parameter}
-        {pattern_parameter}
-        FORCE={force}
-        """.format(
-            table=qualified_table_name(sf_database, sf_schema, sf_table),
-            stage_name=qualified_stage_name(sf_database, sf_schema, sf_table),
-            files_parameter=files_paramater,
-            pattern_parameter=pattern_parameter,
-            force=str(overwrite),
-        )
-
-        logger.info("Copying data into Snowflake as: \n{}".format(query))
-
-        sf_connection.cursor().execute(query)
-        sf_connection.commit()
-    except Exception:
-        sf_connection.rollback()
-        raise
+            params = {'file': file, 'pattern': pattern, 'force': overwrite}
+
+            logger.info("Copying data into Snowflake as: \n{}\nwith parameters: {}".format(query, params))
+
+            cursor.execute(query, params)
+            sf_connection.commit()
+        except Exception:
+            sf_connection.rollback()
+            raise
     finally:
+        cursor.close()
         sf_connection.close()
 
 
@@ -452,18 +488,7 @@ def export_snowflake_table_to_s3(
     table_name = qualified_table_name(sf_database, sf_schema, sf_table)
     export_path = os.path.join(s3_path, table_name.replace('.', '-').lower()) + '/'
 
-    query = """
-        COPY INTO '{export_path}'
-            FROM {table}
-            STORAGE_INTEGRATION = {storage_integration}
-            FILE_FORMAT = ( TYPE = CSV EMPTY_FIELD_AS_NULL = FALSE
-            FIELD_DELIMITER = '{field_delimiter}' FIELD_OPTIONALLY_ENCLOSED_BY = '{enclosed_by}'
-            ESCAPE_UNENCLOSED_FIELD = '{escape_unenclosed_field}'
-            NULL_IF = ( '{null_marker}' )
-            COMPRESSION = NONE
-            )
-            OVERWRITE={overwrite}
-    """.format(
+    query = _EXPORT_COPY_INTO_TEMPLATE.substitute(
         export_path=export_path,
         table=table_name,
         storage_integration=sf_storage_integration,
@@ -532,7 +557,7 @@ def get_batched_rows_from_snowflake(
         sf_role,
     )
 
-    query = 'SELECT {columns} FROM {table}'.format(
+    query = _SELECT_COLUMNS_TEMPLATE.substitute(
         columns=', '.join(columns),
         table=qualified_table_name(sf_database, sf_schema, sf_table),
     )
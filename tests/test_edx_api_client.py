@@ -1,15 +1,22 @@
 """Test the API client"""
 
+import asyncio
 import json
-from datetime import datetime, timedelta
+import os
+import stat
+import tempfile
+import time
 from unittest import TestCase
 
+import aiohttp
 import httpretty
 import requests
+from aioresponses import aioresponses
 from ddt import data, ddt, unpack
-from mock import patch
+from mock import AsyncMock, Mock, patch
 
-from edx_prefectutils.edx_api_client import EdxApiClient
+from edx_prefectutils import edx_api_client
+from edx_prefectutils.edx_api_client import EdxApiClient, get_cached_json
 
 FAKE_AUTH_URL = 'http://example.com/oauth2/access_token'
 FAKE_CLIENT_ID = 'aclientid'
@@ -24,24 +31,14 @@ class EdxApiClientTestCase(TestCase):
     """Test the client"""
 
     def setUp(self):
-        self.current_time = datetime(2016, 1, 1, 0, 0, 0, 0)
         self.time_offset = 0
 
-        class MockDateTime(datetime):
-            """
-            A fake datetime that allows the test to control the return value from the utcnow() method.
-
-            This allows us to emulate the passage of time, by simply changing `self.time_offset`.
-            """
-
-            @classmethod
-            def utcnow(cls):
-                """Return the time specified by the time offset"""
-                return self.current_time + timedelta(seconds=self.time_offset)
-
-        datetime_patcher = patch('edx_prefectutils.edx_api_client.datetime', MockDateTime)
-        datetime_patcher.start()
-        self.addCleanup(datetime_patcher.stop)
+        # Let the test emulate the passage of time by simply changing `self.time_offset`.
+        real_monotonic = time.monotonic
+        monotonic_patcher = patch('time.monotonic', side_effect=lambda: real_monotonic() + self.time_offset)
+        monotonic_patcher.start()
+        self.addCleanup(monotonic_patcher.stop)
+        edx_api_client._TOKEN_CACHE.clear()  # pylint: disable=protected-access
 
         self.client = EdxApiClient(auth_url=FAKE_AUTH_URL, client_id=FAKE_CLIENT_ID, client_secret=FAKE_CLIENT_SECRET)
 
@@ -217,3 +214,287 @@ class EdxApiClientTestCase(TestCase):
         self.assertEqual(
             httpretty.httpretty.latest_requests[5].querystring, {'limit': ['2'], 'foo': ['bar'], 'offset': ['4']}
         )
+
+    def test_paginated_get_async_single_page(self):
+        self.prepare_for_token_request()
+        response_body = {
+            'num_pages': 1,
+            'results': [{'a': 1}, {'a': 2}]
+        }
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL, body=json.dumps(response_body))
+
+        pages = asyncio.run(self.client.paginated_get_async(FAKE_RESOURCE_URL))
+        self.assertEqual(pages, [response_body])
+
+    def test_paginated_get_async_multiple_pages(self):
+        self.prepare_for_token_request()
+        response_bodies = [
+            {'num_pages': 3, 'results': [{'a': 1}]},
+            {'num_pages': 3, 'results': [{'a': 2}]},
+            {'num_pages': 3, 'results': [{'a': 3}]},
+        ]
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL, body=json.dumps(response_bodies[0]))
+
+        with aioresponses() as mocked:
+            mocked.get(FAKE_RESOURCE_URL + '?foo=bar&page=2', status=503)
+            mocked.get(FAKE_RESOURCE_URL + '?foo=bar&page=2', payload=response_bodies[1])
+            mocked.get(FAKE_RESOURCE_URL + '?foo=bar&page=3', payload=response_bodies[2])
+
+            pages = asyncio.run(self.client.paginated_get_async(FAKE_RESOURCE_URL, params={'foo': 'bar'}))
+
+        self.assertEqual(pages, response_bodies)
+        self.assertEqual(httpretty.last_request().querystring, {'foo': ['bar']})
+        page_requests = [call for calls in mocked.requests.values() for call in calls]
+        self.assertEqual(len(page_requests), 3)
+        for call in page_requests:
+            self.assertEqual(call.kwargs['headers'], {'Authorization': 'jwt ' + FAKE_ACCESS_TOKEN})
+
+    def test_paginated_get_async_connection_errors(self):
+        self.prepare_for_token_request()
+        response_bodies = [
+            {'num_pages': 3, 'results': [{'a': 1}]},
+            {'num_pages': 3, 'results': [{'a': 2}]},
+            {'num_pages': 3, 'results': [{'a': 3}]},
+        ]
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL, body=json.dumps(response_bodies[0]))
+
+        with aioresponses() as mocked:
+            mocked.get(FAKE_RESOURCE_URL + '?page=2', exception=aiohttp.ClientConnectionError('Connection reset'))
+            mocked.get(FAKE_RESOURCE_URL + '?page=2', body=json.dumps(response_bodies[1]), content_type='text/plain')
+            mocked.get(FAKE_RESOURCE_URL + '?page=3', exception=asyncio.TimeoutError())
+            mocked.get(FAKE_RESOURCE_URL + '?page=3', body=json.dumps(response_bodies[2]), content_type='text/plain')
+
+            pages = asyncio.run(self.client.paginated_get_async(FAKE_RESOURCE_URL))
+
+        self.assertEqual(pages, response_bodies)
+
+    def test_expiration_skew(self):
+        self.prepare_for_token_request(expires_in=3600, access_token='token1')
+        self.client.ensure_oauth_access_token()
+
+        self.time_offset = 3600 - 61
+        self.client.ensure_oauth_access_token()
+        self.assertEqual(self.client.authenticated_session.auth.token, 'token1')
+
+        self.time_offset = 3600 - 60
+        self.prepare_for_token_request(expires_in=3600, access_token='token2')
+        self.client.ensure_oauth_access_token()
+        self.assertEqual(self.client.authenticated_session.auth.token, 'token2')
+
+    def test_token_shared_between_clients(self):
+        self.prepare_for_token_request()
+        self.client.ensure_oauth_access_token()
+
+        client = EdxApiClient(auth_url=FAKE_AUTH_URL, client_id=FAKE_CLIENT_ID, client_secret=FAKE_CLIENT_SECRET)
+        client.ensure_oauth_access_token()
+
+        self.assertEqual(client.authenticated_session.auth.token, FAKE_ACCESS_TOKEN)
+        self.assertEqual(len(httpretty.httpretty.latest_requests), 1)
+
+    @patch('time.sleep')
+    def test_retry_after(self, sleep_mock):
+        self.prepare_for_token_request()
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL,
+                               responses=[
+                                   httpretty.Response(body='Too many requests!', status=429,
+                                                      adding_headers={'Retry-After': '5'}),
+                                   httpretty.Response(body='{}', status=200)
+                               ])
+
+        responses = list(self.client.paginated_get(FAKE_RESOURCE_URL))
+        self.assertEqual(len(responses), 1)
+        sleep_mock.assert_any_call(5)
+
+    @patch('time.sleep')
+    def test_retry_after_past_timeout(self, sleep_mock):
+        self.prepare_for_token_request()
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL,
+                               responses=[
+                                   httpretty.Response(body='Too many requests!', status=429,
+                                                      adding_headers={'Retry-After': '86400'}),
+                                   httpretty.Response(body='{}', status=200)
+                               ])
+
+        with self.assertRaises(requests.HTTPError):
+            list(self.client.paginated_get(FAKE_RESOURCE_URL, timeout_seconds=60))
+        self.assertNotIn(86400, [call.args[0] for call in sleep_mock.call_args_list])
+
+    def test_paginated_get_async_retry_after(self):
+        self.prepare_for_token_request()
+        response_bodies = [
+            {'num_pages': 2, 'results': [{'a': 1}]},
+            {'num_pages': 2, 'results': [{'a': 2}]},
+        ]
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL, body=json.dumps(response_bodies[0]))
+
+        with aioresponses() as mocked, patch('asyncio.sleep', new_callable=AsyncMock) as sleep_mock:
+            mocked.get(FAKE_RESOURCE_URL + '?page=2', status=429, headers={'Retry-After': '5'})
+            mocked.get(FAKE_RESOURCE_URL + '?page=2', payload=response_bodies[1])
+
+            pages = asyncio.run(self.client.paginated_get_async(FAKE_RESOURCE_URL))
+
+        self.assertEqual(pages, response_bodies)
+        sleep_mock.assert_any_await(5)
+
+    def test_paginated_get_async_retry_after_past_timeout(self):
+        self.prepare_for_token_request()
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL, body=json.dumps({'num_pages': 2, 'results': []}))
+
+        with aioresponses() as mocked:
+            mocked.get(FAKE_RESOURCE_URL + '?page=2', status=429, headers={'Retry-After': '86400'})
+            with self.assertRaises(aiohttp.ClientResponseError):
+                asyncio.run(self.client.paginated_get_async(FAKE_RESOURCE_URL, timeout_seconds=60))
+
+    def test_paginated_get_hedged(self):
+        self.prepare_for_token_request()
+        response_body = {'results': [{'a': 1}]}
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL, body=json.dumps(response_body))
+
+        responses = list(self.client.paginated_get(FAKE_RESOURCE_URL, hedge_delay_seconds=30))
+        self.assertEqual([response.json() for response in responses], [response_body])
+
+    @staticmethod
+    def make_hedged_response(body):
+        response = Mock(spec=requests.Response, status_code=200, content=json.dumps(body).encode(), headers={})
+        response.raise_for_status.return_value = None
+        return response
+
+    def test_paginated_get_hedged_slow_primary(self):
+        self.prepare_for_token_request()
+        primary_response = self.make_hedged_response({'results': [{'from': 'primary'}]})
+        hedge_response = self.make_hedged_response({'results': [{'from': 'hedge'}]})
+        calls = []
+
+        def slow_primary_get(*args, **kwargs):  # pylint: disable=unused-argument
+            calls.append(args)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return primary_response
+            return hedge_response
+
+        with patch('requests.Session.get', side_effect=slow_primary_get, autospec=True):
+            responses = list(self.client.paginated_get(FAKE_RESOURCE_URL, hedge_delay_seconds=0.05))
+
+        self.assertEqual(responses, [hedge_response])
+        self.assertEqual(len(calls), 2)
+        # The primary request used the client's session and the hedge a session of its own.
+        self.assertIsNot(calls[0][0], calls[1][0])
+        deadline = time.monotonic() + 5
+        while not primary_response.close.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+        primary_response.close.assert_called_once_with()
+        hedge_response.close.assert_not_called()
+
+    def test_paginated_get_hedged_failing_primary(self):
+        self.prepare_for_token_request()
+        hedge_response = self.make_hedged_response({'results': [{'from': 'hedge'}]})
+        calls = []
+
+        def failing_primary_get(*args, **kwargs):  # pylint: disable=unused-argument
+            calls.append(args)
+            if len(calls) == 1:
+                time.sleep(0.2)
+                raise requests.ConnectionError('Connection reset by peer')
+            return hedge_response
+
+        with patch('requests.Session.get', side_effect=failing_primary_get, autospec=True):
+            responses = list(self.client.paginated_get(FAKE_RESOURCE_URL, hedge_delay_seconds=0.05))
+
+        self.assertEqual(responses, [hedge_response])
+        self.assertEqual(len(calls), 2)
+
+    def test_get_cached_json(self):
+        self.prepare_for_token_request()
+        response_body = {'results': [{'a': 1}]}
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL, body=json.dumps(response_body))
+
+        response = next(self.client.paginated_get(FAKE_RESOURCE_URL, pagination_key=lambda r: r.get('next')))
+        with patch('edx_prefectutils.edx_api_client.orjson.loads') as loads_mock:
+            self.assertEqual(get_cached_json(response), response_body)
+            loads_mock.assert_not_called()
+
+    def test_paginated_get_not_modified(self):
+        self.prepare_for_token_request()
+        response_body = {'results': [{'a': 1}]}
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL,
+                               responses=[
+                                   httpretty.Response(body=json.dumps(response_body),
+                                                      adding_headers={'ETag': '"v1"'}),
+                                   httpretty.Response(body='', status=304),
+                               ])
+        cache_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_directory.cleanup)
+        client = EdxApiClient(auth_url=FAKE_AUTH_URL, client_id=FAKE_CLIENT_ID, client_secret=FAKE_CLIENT_SECRET,
+                              cache_directory=cache_directory.name)
+
+        responses = list(client.paginated_get(FAKE_RESOURCE_URL, cache_ttl_seconds=60))
+        self.assertEqual([response.json() for response in responses], [response_body])
+
+        responses = list(client.paginated_get(FAKE_RESOURCE_URL, cache_ttl_seconds=60))
+        self.assertEqual([response.json() for response in responses], [response_body])
+        self.assertEqual(httpretty.last_request().headers['If-None-Match'], '"v1"')
+
+    def test_paginated_get_cache_leaves_out_token(self):
+        self.prepare_for_token_request()
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL, body=json.dumps({'results': []}),
+                               adding_headers={'ETag': '"v1"'})
+        cache_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_directory.cleanup)
+        client = EdxApiClient(auth_url=FAKE_AUTH_URL, client_id=FAKE_CLIENT_ID, client_secret=FAKE_CLIENT_SECRET,
+                              cache_directory=cache_directory.name)
+
+        list(client.paginated_get(FAKE_RESOURCE_URL, cache_ttl_seconds=60))
+        client._response_cache.close()  # pylint: disable=protected-access
+
+        for directory, _, file_names in os.walk(cache_directory.name):
+            for file_name in file_names:
+                with open(os.path.join(directory, file_name), 'rb') as cache_file:
+                    self.assertNotIn(FAKE_ACCESS_TOKEN.encode(), cache_file.read())
+
+    def test_paginated_get_not_modified_without_cache_entry(self):
+        self.prepare_for_token_request()
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL, body='', status=304)
+        cache_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_directory.cleanup)
+        client = EdxApiClient(auth_url=FAKE_AUTH_URL, client_id=FAKE_CLIENT_ID, client_secret=FAKE_CLIENT_SECRET,
+                              cache_directory=cache_directory.name)
+
+        responses = list(client.paginated_get(FAKE_RESOURCE_URL, cache_ttl_seconds=60))
+        self.assertEqual([response.status_code for response in responses], [304])
+
+    def test_paginated_get_default_cache_directory(self):
+        self.prepare_for_token_request()
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL, body=json.dumps({'results': []}))
+        home_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(home_directory.cleanup)
+        cache_directory = os.path.join(home_directory.name, 'edx_api_cache')
+
+        with patch('edx_prefectutils.edx_api_client.DEFAULT_CACHE_DIRECTORY', cache_directory):
+            client = EdxApiClient(auth_url=FAKE_AUTH_URL, client_id=FAKE_CLIENT_ID, client_secret=FAKE_CLIENT_SECRET)
+        list(client.paginated_get(FAKE_RESOURCE_URL, cache_ttl_seconds=60))
+
+        self.assertEqual(stat.S_IMODE(os.stat(cache_directory).st_mode), 0o700)
+
+    def test_token_not_shared_with_other_secret(self):
+        self.prepare_for_token_request()
+        self.client.ensure_oauth_access_token()
+
+        client = EdxApiClient(auth_url=FAKE_AUTH_URL, client_id=FAKE_CLIENT_ID, client_secret='wrongsecret')
+        client.ensure_oauth_access_token()
+
+        self.assert_token_request_body(FAKE_CLIENT_ID, 'wrongsecret')
+        self.assertEqual(len(httpretty.httpretty.latest_requests), 2)
+
+    def test_get_cached_json_string_pagination_key(self):
+        self.prepare_for_token_request()
+        response_bodies = [
+            {'results': [{'a': 1}], 'next': FAKE_RESOURCE_URL + '?page=2'},
+            {'results': [{'a': 2}], 'next': None},
+        ]
+        httpretty.register_uri('GET', FAKE_RESOURCE_URL,
+                               responses=[httpretty.Response(body=json.dumps(body)) for body in response_bodies])
+
+        responses = list(self.client.paginated_get(FAKE_RESOURCE_URL))
+        with patch('edx_prefectutils.edx_api_client.orjson.loads') as loads_mock:
+            self.assertEqual([get_cached_json(response) for response in responses], response_bodies)
+            loads_mock.assert_not_called()
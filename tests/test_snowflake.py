@@ -50,6 +50,7 @@ def test_create_snowflake_connection(mocker):  # noqa: F811
     mock_key = mocker.Mock()
     mock_key.private_bytes.return_value = 1234
     snowflake.serialization.load_pem_private_key.return_value = mock_key
+    snowflake._load_private_key_der.cache_clear()  # pylint: disable=protected-access
     # Call the connection method.
     snowflake.create_snowflake_connection(
         credentials={
@@ -67,19 +68,34 @@ def test_create_snowflake_connection(mocker):  # noqa: F811
         user='test_user',
         warehouse=None,
         password=None,
+        role='test_role',
+        session_parameters={'TIMEZONE': 'UTC'},
     )
-    mock_cursor.execute.assert_has_calls(
-        (
-            mocker.call("USE ROLE test_role"),
-            mocker.call("ALTER SESSION SET TIMEZONE = 'UTC'"),
-        )
-    )
+    mock_cursor.execute.assert_not_called()
+
+
+def test_create_snowflake_connection_caches_private_key(mocker):  # noqa: F811
+    mocker.patch.object(snowflake.snowflake.connector, 'connect')
+    mocker.patch.object(snowflake.serialization, 'load_pem_private_key')
+    snowflake.serialization.load_pem_private_key.return_value.private_bytes.return_value = 1234
+    snowflake._load_private_key_der.cache_clear()  # pylint: disable=protected-access
+    credentials = {
+        "private_key": "this_is_an_encrypted_private_key",
+        "private_key_passphrase": "passphrase_for_the_private_key",
+        "user": "test_user",
+        "account": "company-cloud-region"
+    }
+
+    snowflake.create_snowflake_connection(credentials=credentials, role="test_role")
+    snowflake.create_snowflake_connection(credentials=credentials, role="test_role")
+
+    snowflake.serialization.load_pem_private_key.assert_called_once()
 
 
 def test_load_json_objects_to_snowflake_no_existing_table(mock_sf_connection):
     # Mock the Snowflake connection, cursor, and fetchone method.
     mock_cursor = mock_sf_connection.cursor()
-    mock_fetchone = mock.Mock(side_effect=ProgrammingError("does not exist"))
+    mock_fetchone = mock.Mock(return_value=None)
     mock_cursor.fetchone = mock_fetchone
 
     with Flow("test") as f:
@@ -99,10 +115,10 @@ def test_load_json_objects_to_snowflake_no_existing_table(mock_sf_connection):
     assert state.is_successful()
     mock_cursor.execute.assert_has_calls(
         [
-            mock.call("\n        SELECT 1 FROM test_database.test_schema.test_table\n        WHERE session:date='2020-01-01'\n            AND ga_view_id='test_dataset'\n        "), # noqa
-            mock.call('\n        CREATE TABLE IF NOT EXISTS test_database.test_schema.test_table (\n            id number autoincrement start 1 increment 1,\n            load_time timestamp_ltz default current_timestamp(),\n            ga_view_id string,\n            session VARIANT\n        );\n        '), # noqa
-            mock.call("\n        CREATE OR REPLACE STAGE test_database.test_schema.test_table_stage\n            URL = 'gcs://test-location'\n            STORAGE_INTEGRATION = test_storage_integration\n            FILE_FORMAT = (TYPE = JSON);\n        "), # noqa
-            mock.call("\n        COPY INTO test_database.test_schema.test_table (ga_view_id, session)\n            FROM (\n                SELECT\n                    'test_dataset',\n                    t.$1\n                FROM @test_database.test_schema.test_table_stage t\n            )\n        PATTERN='.*'\n        FORCE=False\n        "), # noqa
+            mock.call("\nSELECT TRUE FROM test_database.INFORMATION_SCHEMA.TABLES\nWHERE TABLE_SCHEMA=UPPER(%(schema)s)\n    AND TABLE_NAME=UPPER(%(table)s)\nLIMIT 1\n", {'schema': 'test_schema', 'table': 'test_table'}),  # noqa
+            mock.call("\nCREATE TABLE IF NOT EXISTS test_database.test_schema.test_table (\n    id number autoincrement start 1 increment 1,\n    load_time timestamp_ltz default current_timestamp(),\n    ga_view_id string,\n    session VARIANT\n);\n"), # noqa
+            mock.call("\nCREATE OR REPLACE STAGE test_database.test_schema.test_table_stage\n    URL = 'gcs://test-location'\n    STORAGE_INTEGRATION = test_storage_integration\n    FILE_FORMAT = (TYPE = JSON);\n"), # noqa
+            mock.call("\nCOPY INTO test_database.test_schema.test_table (ga_view_id, session)\n    FROM (\n        SELECT\n            %(ga_view_id)s,\n            t.$1\n        FROM @test_database.test_schema.test_table_stage t\n    )\nPATTERN=%(pattern)s\nFORCE=%(force)s\n", {'ga_view_id': 'test_dataset', 'pattern': '.*', 'force': False}), # noqa
         ]
     )
 
@@ -129,12 +145,14 @@ def test_load_json_objects_to_snowflake_error_on_table_exist_check(mock_sf_conne
     with raise_on_exception():
         with pytest.raises(ProgrammingError):
             f.run()
+    mock_cursor.close.assert_called()
+    mock_sf_connection.close.assert_called()
 
 
 def test_load_json_objects_to_snowflake_overwrite(mock_sf_connection):
     # Mock the Snowflake connection, cursor, and fetchone method.
     mock_cursor = mock_sf_connection.cursor()
-    mock_fetchone = mock.Mock(return_value=None)
+    mock_fetchone = mock.Mock(side_effect=[(1,), None])
     mock_cursor.fetchone = mock_fetchone
 
     with Flow("test") as f:
@@ -155,11 +173,11 @@ def test_load_json_objects_to_snowflake_overwrite(mock_sf_connection):
     assert state.is_successful()
     mock_cursor.execute.assert_has_calls(
         [
-            mock.call("\n        SELECT 1 FROM test_database.test_schema.test_table\n        WHERE session:date='2020-01-01'\n            AND ga_view_id='test_dataset'\n        "), # noqa
-            mock.call('\n        CREATE TABLE IF NOT EXISTS test_database.test_schema.test_table (\n            id number autoincrement start 1 increment 1,\n            load_time timestamp_ltz default current_timestamp(),\n            ga_view_id string,\n            session VARIANT\n        );\n        '), # noqa
-            mock.call("\n            DELETE FROM test_database.test_schema.test_table\n            WHERE session:date='2020-01-01'\n                AND ga_view_id='test_dataset'\n            "), # noqa
-            mock.call("\n        CREATE OR REPLACE STAGE test_database.test_schema.test_table_stage\n            URL = 'gcs://test-location'\n            STORAGE_INTEGRATION = test_storage_integration\n            FILE_FORMAT = (TYPE = JSON);\n        "), # noqa
-            mock.call("\n        COPY INTO test_database.test_schema.test_table (ga_view_id, session)\n            FROM (\n                SELECT\n                    'test_dataset',\n                    t.$1\n                FROM @test_database.test_schema.test_table_stage t\n            )\n        PATTERN='.*'\n        FORCE=True\n        "), # noqa
+            mock.call("\nSELECT TRUE FROM test_database.INFORMATION_SCHEMA.TABLES\nWHERE TABLE_SCHEMA=UPPER(%(schema)s)\n    AND TABLE_NAME=UPPER(%(table)s)\nLIMIT 1\n", {'schema': 'test_schema', 'table': 'test_table'}),  # noqa
+            mock.call("\nSELECT TRUE FROM test_database.test_schema.test_table\nWHERE session:date=%(date)s\n    AND ga_view_id=%(ga_view_id)s\nLIMIT 1\n", {'date': '2020-01-01', 'ga_view_id': 'test_dataset'}), # noqa
+            mock.call("\nDELETE FROM test_database.test_schema.test_table\nWHERE session:date=%(date)s\n    AND ga_view_id=%(ga_view_id)s\n", {'date': '2020-01-01', 'ga_view_id': 'test_dataset'}), # noqa
+            mock.call("\nCREATE OR REPLACE STAGE test_database.test_schema.test_table_stage\n    URL = 'gcs://test-location'\n    STORAGE_INTEGRATION = test_storage_integration\n    FILE_FORMAT = (TYPE = JSON);\n"), # noqa
+            mock.call("\nCOPY INTO test_database.test_schema.test_table (ga_view_id, session)\n    FROM (\n        SELECT\n            %(ga_view_id)s,\n            t.$1\n        FROM @test_database.test_schema.test_table_stage t\n    )\nPATTERN=%(pattern)s\nFORCE=%(force)s\n", {'ga_view_id': 'test_dataset', 'pattern': '.*', 'force': True}), # noqa
         ]
     )
 
@@ -185,7 +203,15 @@ def test_load_json_objects_to_snowflake_table_exists_no_overwrite(mock_sf_connec
         )
     state = f.run()
     assert state.is_successful()
-    mock_cursor.execute.assert_called_once_with("\n        SELECT 1 FROM test_database.test_schema.test_table\n        WHERE session:date='2020-01-01'\n            AND ga_view_id='test_dataset'\n        ") # noqa
+    mock_cursor.execute.assert_has_calls(
+        [
+            mock.call("\nSELECT TRUE FROM test_database.INFORMATION_SCHEMA.TABLES\nWHERE TABLE_SCHEMA=UPPER(%(schema)s)\n    AND TABLE_NAME=UPPER(%(table)s)\nLIMIT 1\n", {'schema': 'test_schema', 'table': 'test_table'}),  # noqa
+            mock.call("\nSELECT TRUE FROM test_database.test_schema.test_table\nWHERE session:date=%(date)s\n    AND ga_view_id=%(ga_view_id)s\nLIMIT 1\n", {'date': '2020-01-01', 'ga_view_id': 'test_dataset'}), # noqa
+        ]
+    )
+    assert mock_cursor.execute.call_count == 2
+    mock_cursor.close.assert_called_once_with()
+    mock_sf_connection.close.assert_called_once_with()
 
 
 def test_load_json_objects_to_snowflake_table_general_exception(mock_sf_connection):
@@ -232,7 +258,7 @@ def test_load_s3_data_to_snowflake_missing_parameters():
 def test_load_s3_data_to_snowflake_no_existing_table(mock_sf_connection):
     # Mock the Snowflake connection, cursor, and fetchone method.
     mock_cursor = mock_sf_connection.cursor()
-    mock_fetchone = mock.Mock(side_effect=ProgrammingError("does not exist"))
+    mock_fetchone = mock.Mock(return_value=None)
     mock_cursor.fetchone = mock_fetchone
 
     task = snowflake.load_s3_data_to_snowflake
@@ -252,10 +278,10 @@ def test_load_s3_data_to_snowflake_no_existing_table(mock_sf_connection):
     )
     mock_cursor.execute.assert_has_calls(
         [
-            mock.call("\n        SELECT 1 FROM test_database.test_schema.test_table\n        WHERE date(PROPERTIES:date)=date('2020-01-01')\n        "),  # noqa
-            mock.call('\n        CREATE TABLE IF NOT EXISTS test_database.test_schema.test_table (\n            ID NUMBER AUTOINCREMENT START 1 INCREMENT 1,\n            LOAD_TIME TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP(),\n            ORIGIN_FILE_NAME VARCHAR(16777216),\n            ORIGIN_FILE_LINE NUMBER(38,0),\n            ORIGIN_STR VARCHAR(16777216),\n            PROPERTIES VARIANT\n        );\n        '),  # noqa
-            mock.call("\n        CREATE STAGE IF NOT EXISTS test_database.test_schema.test_table_stage\n            URL = 's3://edx-test/test/'\n            STORAGE_INTEGRATION = test_storage_integration\n            FILE_FORMAT = (TYPE='JSON', STRIP_OUTER_ARRAY=TRUE);\n        "),  # noqa
-            mock.call("\n        COPY INTO test_database.test_schema.test_table (origin_file_name, origin_file_line, origin_str, properties)\n            FROM (\n                SELECT\n                    metadata$filename,\n                    metadata$file_row_number,\n                    t.$1,\n                    CASE\n                        WHEN CHECK_JSON(t.$1) IS NULL THEN t.$1\n                        ELSE NULL\n                    END\n                FROM @test_database.test_schema.test_table_stage t\n            )\n        FILES = ( 'test_file.csv' )\n        PATTERN = '.*'\n        FORCE=False\n        ")  # noqa
+            mock.call("\nSELECT TRUE FROM test_database.INFORMATION_SCHEMA.TABLES\nWHERE TABLE_SCHEMA=UPPER(%(schema)s)\n    AND TABLE_NAME=UPPER(%(table)s)\nLIMIT 1\n", {'schema': 'test_schema', 'table': 'test_table'}),  # noqa
+            mock.call("\nCREATE TABLE IF NOT EXISTS test_database.test_schema.test_table (\n    ID NUMBER AUTOINCREMENT START 1 INCREMENT 1,\n    LOAD_TIME TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP(),\n    ORIGIN_FILE_NAME VARCHAR(16777216),\n    ORIGIN_FILE_LINE NUMBER(38,0),\n    ORIGIN_STR VARCHAR(16777216),\n    PROPERTIES VARIANT\n);\n"),  # noqa
+            mock.call("\nCREATE STAGE IF NOT EXISTS test_database.test_schema.test_table_stage\n    URL = 's3://edx-test/test/'\n    STORAGE_INTEGRATION = test_storage_integration\n    FILE_FORMAT = (TYPE='JSON', STRIP_OUTER_ARRAY=TRUE);\n"),  # noqa
+            mock.call("\nCOPY INTO test_database.test_schema.test_table (origin_file_name, origin_file_line, origin_str, properties)\n    FROM (\n        SELECT\n            metadata$filename,\n            metadata$file_row_number,\n            t.$1,\n            CASE\n                WHEN CHECK_JSON(t.$1) IS NULL THEN t.$1\n                ELSE NULL\n            END\n        FROM @test_database.test_schema.test_table_stage t\n    )\nFILES = ( %(file)s )\nPATTERN = %(pattern)s\nFORCE=%(force)s\n", {'file': 'test_file.csv', 'pattern': '.*', 'force': False})  # noqa
         ]
     )
 
@@ -280,6 +306,8 @@ def test_load_s3_data_to_snowflake_data_exists_no_overwrite(mock_sf_connection):
             s3_url="s3://edx-test/test/",
             pattern=".*",
         )
+    mock_cursor.close.assert_called_once_with()
+    mock_sf_connection.close.assert_called_once_with()
 
 
 def test_export_snowflake_table_to_s3_with_exception(mock_sf_connection):
@@ -321,7 +349,7 @@ def test_export_snowflake_table_to_s3_overwrite(mock_sf_connection):  # noqa: F8
 
     mock_cursor.execute.assert_has_calls(
         [
-            mock.call("\n        COPY INTO 's3://edx-test/test/test_database-test_schema-test_table/'\n            FROM test_database.test_schema.test_table\n            STORAGE_INTEGRATION = test_storage_integration\n            FILE_FORMAT = ( TYPE = CSV EMPTY_FIELD_AS_NULL = FALSE\n            FIELD_DELIMITER = ',' FIELD_OPTIONALLY_ENCLOSED_BY = 'NONE'\n            ESCAPE_UNENCLOSED_FIELD = '\\\\'\n            NULL_IF = ( 'NULL' )\n            COMPRESSION = NONE\n            )\n            OVERWRITE=True\n    "),  # noqa
+            mock.call("\nCOPY INTO 's3://edx-test/test/test_database-test_schema-test_table/'\n    FROM test_database.test_schema.test_table\n    STORAGE_INTEGRATION = test_storage_integration\n    FILE_FORMAT = ( TYPE = CSV EMPTY_FIELD_AS_NULL = FALSE\n    FIELD_DELIMITER = ',' FIELD_OPTIONALLY_ENCLOSED_BY = 'NONE'\n    ESCAPE_UNENCLOSED_FIELD = '\\\\'\n    NULL_IF = ( 'NULL' )\n    COMPRESSION = NONE\n    )\n    OVERWRITE=True\n"),  # noqa
         ]
     )
 
@@ -346,6 +374,6 @@ def test_export_snowflake_table_to_s3_no_overwrite(mock_sf_connection):  # noqa:
 
     mock_cursor.execute.assert_has_calls(
         [
-            mock.call("\n        COPY INTO 's3://edx-test/test/test_database-test_schema-test_table/'\n            FROM test_database.test_schema.test_table\n            STORAGE_INTEGRATION = test_storage_integration\n            FILE_FORMAT = ( TYPE = CSV EMPTY_FIELD_AS_NULL = FALSE\n            FIELD_DELIMITER = ',' FIELD_OPTIONALLY_ENCLOSED_BY = 'NONE'\n            ESCAPE_UNENCLOSED_FIELD = '\\\\'\n            NULL_IF = ( 'NULL' )\n            COMPRESSION = NONE\n            )\n            OVERWRITE=False\n    "),  # noqa
+            mock.call("\nCOPY INTO 's3://edx-test/test/test_database-test_schema-test_table/'\n    FROM test_database.test_schema.test_table\n    STORAGE_INTEGRATION = test_storage_integration\n    FILE_FORMAT = ( TYPE = CSV EMPTY_FIELD_AS_NULL = FALSE\n    FIELD_DELIMITER = ',' FIELD_OPTIONALLY_ENCLOSED_BY = 'NONE'\n    ESCAPE_UNENCLOSED_FIELD = '\\\\'\n    NULL_IF = ( 'NULL' )\n    COMPRESSION = NONE\n    )\n    OVERWRITE=False\n"),  # noqa
         ]
     )